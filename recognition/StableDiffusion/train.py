@@ -0,0 +1,147 @@
+"""
+Training script for the diffusion UNet on the OASIS brain MRI slices.
+
+The images are noised to a random diffusion time step with `add_noise`
+and the UNet is trained with an MSE loss to predict the noise that was
+added.
+"""
+
+import torch
+import torch.nn as nn
+import torchvision
+from torch.utils.data import DataLoader
+
+from blocks import UNet
+from utils import NoiseSchedule, save_loss_data
+
+# fixed shapes every step, so let cuDNN pick the fastest conv algorithms
+torch.backends.cudnn.benchmark = True
+# TF32 tensor cores for any fp32 matmuls/convs left outside autocast
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
+IMAGE_SIZE = 64
+BATCH_SIZE = 16
+EPOCHS = 100
+LEARNING_RATE = 3e-4
+TIME_STEPS = 1000
+# torch.compile with mode="reduce-overhead" wraps the compiled graph in
+# CUDA graphs itself; the manual capture is kept as a fallback.
+USE_COMPILE = True
+USE_CUDA_GRAPH = False
+
+
+def graph_unet(unet):
+    """Capture the UNet forward/backward into a CUDA graph.
+
+    The UNet launches hundreds of small kernels per step, so replaying a
+    captured graph removes most of the CPU launch overhead. Capture is
+    done at the fixed training batch shape; make_graphed_callables
+    performs the warmup iterations on a side stream and allocates the
+    static input/output tensors itself. Noise sampling stays outside the
+    captured region (in add_noise) so torch.randn_like is not replayed
+    with a frozen RNG state.
+    """
+    static_x = torch.zeros(BATCH_SIZE, 1, IMAGE_SIZE, IMAGE_SIZE,
+                           device="cuda").contiguous(memory_format=torch.channels_last)
+    static_pos = torch.zeros(BATCH_SIZE, dtype=torch.long, device="cuda")
+    return torch.cuda.graphs.make_graphed_callables(unet, (static_x, static_pos))
+
+
+def load_data(path):
+    """Load the OASIS png slices as grayscale tensors in [-1, 1]."""
+    transform = torchvision.transforms.Compose([
+        torchvision.transforms.Grayscale(),
+        torchvision.transforms.Resize(IMAGE_SIZE),
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize(0.5, 0.5),
+    ])
+    dataset = torchvision.datasets.ImageFolder(path, transform=transform)
+    return DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, drop_last=True)
+
+
+class NoisePrefetcher:
+    """Generates the next batch of Gaussian noise on a side CUDA stream.
+
+    randn over a full image batch is a bandwidth bound pass of its own,
+    so it is launched right after optimizer.step() and overlaps with the
+    tail of the previous iteration instead of sitting on the critical
+    path in front of the UNet forward.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.stream = torch.cuda.Stream()
+        self.prefetch()
+
+    def prefetch(self):
+        with torch.cuda.stream(self.stream):
+            self.next_noise = torch.randn(self.shape, device="cuda")
+
+    def get(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        noise = self.next_noise
+        noise.record_stream(torch.cuda.current_stream())
+        return noise
+
+
+def train(train_path, test_path):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    train_loader = load_data(train_path)
+    test_loader = load_data(test_path)
+    unet = UNet().to(device)
+    optimizer = torch.optim.Adam(unet.parameters(), lr=LEARNING_RATE)
+    criterion = nn.MSELoss()
+    noise_schedule = NoiseSchedule().to(device)
+    prefetcher = (NoisePrefetcher((BATCH_SIZE, 1, IMAGE_SIZE, IMAGE_SIZE))
+                  if device == "cuda" else None)
+    if USE_COMPILE and device == "cuda":
+        train_step = torch.compile(unet, mode="reduce-overhead",
+                                   fullgraph=False, dynamic=False)
+    elif USE_CUDA_GRAPH and device == "cuda":
+        train_step = graph_unet(unet)
+    else:
+        train_step = unet
+
+    tracked_loss = []
+    test_loss = []
+    for epoch in range(EPOCHS):
+        epoch_loss = 0
+        for x, _ in train_loader:
+            x = x.to(device)
+            pos = torch.randint(0, TIME_STEPS, (x.shape[0],), device=device)
+            E = prefetcher.get() if prefetcher else None
+            noised_x, noise = noise_schedule.add_noise(x, pos, E)
+            # bf16 needs no loss scaler and halves activation bandwidth
+            with torch.autocast("cuda", dtype=torch.bfloat16, enabled=device == "cuda"):
+                predicted_noise = train_step(noised_x, pos)
+                loss = criterion(predicted_noise, noise)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if prefetcher:
+                prefetcher.prefetch()
+            epoch_loss += loss.item()
+        tracked_loss.append(epoch_loss / len(train_loader))
+
+        with torch.no_grad():
+            epoch_loss = 0
+            for x, _ in test_loader:
+                x = x.to(device)
+                pos = torch.randint(0, TIME_STEPS, (x.shape[0],), device=device)
+                noised_x, noise = noise_schedule.add_noise(x, pos)
+                with torch.autocast("cuda", dtype=torch.bfloat16, enabled=device == "cuda"):
+                    predicted_noise = unet(noised_x, pos)
+                    epoch_loss += criterion(predicted_noise, noise).item()
+            test_loss.append(epoch_loss / len(test_loader))
+
+        print("Epoch {} train loss {:.5f} test loss {:.5f}".format(
+            epoch, tracked_loss[-1], test_loss[-1]))
+        save_loss_data(tracked_loss, test_loss)
+        torch.save(unet.state_dict(), "unet.pt")
+
+
+if __name__ == "__main__":
+    train("keras_png_slices_data/keras_png_slices_train",
+          "keras_png_slices_data/keras_png_slices_test")
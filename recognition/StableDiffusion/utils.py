@@ -0,0 +1,56 @@
+"""
+Helper functions for the diffusion model: the noise schedule, the
+forward (noising) process used to build training pairs and saving of the
+tracked losses.
+"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def get_noise_cadence():
+    """Linear beta schedule over the 1000 diffusion steps."""
+    return torch.linspace(1e-4, 0.02, 1000)
+
+
+class NoiseSchedule(nn.Module):
+    """Precomputed forward diffusion schedule.
+
+    The cumulative alpha products only depend on the beta schedule, so
+    they are computed once here and registered as buffers that move to
+    the GPU with the module, instead of being rebuilt (and copied host
+    to device) on every training step.
+    """
+
+    def __init__(self):
+        super(NoiseSchedule, self).__init__()
+        beta = get_noise_cadence()
+        alpha_cumprod = torch.cumprod(1 - beta, dim=0)
+        self.register_buffer("beta", beta)
+        self.register_buffer("alpha", 1 - beta)
+        self.register_buffer("alpha_cumprod", alpha_cumprod)
+        self.register_buffer("sqrt_alpha_cumprod", torch.sqrt(alpha_cumprod))
+        self.register_buffer("sqrt_one_minus_alpha_cumprod", torch.sqrt(1 - alpha_cumprod))
+
+    def add_noise(self, x, pos, E=None):
+        """Apply the forward diffusion process to a batch of images.
+
+        Returns the noised images at time step `pos` together with the
+        noise that was added, which is the target the UNet is trained to
+        predict. `pos` is expected to already live on the same device as
+        `x` so the indexing stays device local. Pre-generated noise can
+        be passed in as `E` (e.g. from a side stream); otherwise it is
+        sampled here.
+        """
+        if E is None:
+            E = torch.randn_like(x)
+        noised_x = (self.sqrt_alpha_cumprod[pos][:, None, None, None] * x
+                    + self.sqrt_one_minus_alpha_cumprod[pos][:, None, None, None] * E)
+        return noised_x, E
+
+
+def save_loss_data(tracked_loss, test_loss):
+    """Write the per epoch training and test losses out to csv files."""
+    np.savetxt("Epoch Loss.csv", np.asarray(tracked_loss), delimiter=",")
+    np.savetxt("Test Loss.csv", np.asarray(test_loss), delimiter=",")